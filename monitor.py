@@ -1,10 +1,15 @@
 import os
 import re
+import sys
 import json
+import hashlib
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import msgpack
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # --- Load Environment Variables for Local Testing ---
@@ -13,18 +18,65 @@ load_dotenv()
 # --- Configuration ---
 NOTICES_URL = "https://pu.edu.np/notices/"
 # The state file will now be created in the main (root) directory
-STATE_FILE_PATH = "date_counts.json" 
+STATE_FILE_PATH = "date_counts.msgpack" 
+# Validators and body hash of the last response, used to skip unchanged pages
+HTTP_CACHE_PATH = "http_cache.msgpack"
 
 # --- Telegram Configuration ---
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
+# Notifications are sent off the main thread so saving state doesn't wait on Telegram
+EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+# --- HTTP Session ---
+# One pooled session for both the notices fetch and the Telegram API, so
+# connections are reused and transient server errors are retried.
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': USER_AGENT})
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# --- Page Parsing ---
+# The page is never parsed into a tree. Script/style blocks and comments are
+# blanked out first, so a "<body" inside them can't be taken for the real tag.
+# Only the part from <body> on is then scanned, with tags and whitespace
+# character references blanked too. The date regex thus only sees the body's
+# visible text, and dates split across tags still match.
+#
+# Known difference from the old soup.body.get_text() path: \d only matches
+# ASCII digits on bytes, so dates written with non-ASCII digits are not counted.
+# Whitespace references outside the list below are not counted as whitespace either.
+NON_TEXT_RE = re.compile(
+    rb'<(script|style|template)\b.*?</\1\s*>|<!--.*?-->',
+    re.IGNORECASE | re.DOTALL,
+)
+BODY_RE = re.compile(rb'<body\b', re.IGNORECASE)
+MARKUP_RE = re.compile(
+    rb'<[^>]+>'
+    rb'|&#0*(?:9|10|13|32|160);|&#x0*(?:9|a|d|20|a0);'
+    rb'|&(?:Tab|NewLine|nbsp|ensp|emsp|thinsp);|&nbsp(?![0-9a-z])'
+    rb'|\xc2\xa0|\xe2\x80[\x80-\x8a]',
+    re.IGNORECASE,
+)
+DATE_RE = re.compile(
+    rb'\b(\d{1,2})\s+(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+(\d{4})\b',
+    re.IGNORECASE,
+)
 
 def send_telegram_message(message):
-    """Sends a formatted message to the configured Telegram chat."""
+    """Queues a formatted message to be sent to the configured Telegram chat."""
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         print("ERROR: Telegram credentials are not set. Cannot send message.")
-        return
+        return None
 
+    return EXECUTOR.submit(_post_telegram_message, message)
+
+def _post_telegram_message(message):
+    """Posts the message to the Telegram Bot API. Runs on the executor thread."""
     api_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {
         'chat_id': TELEGRAM_CHAT_ID,
@@ -34,7 +86,7 @@ def send_telegram_message(message):
     }
     
     try:
-        response = requests.post(api_url, data=payload, timeout=10)
+        response = SESSION.post(api_url, data=payload, timeout=10)
         response.raise_for_status()
         print("LOG: Successfully sent Telegram notification.")
     except requests.exceptions.RequestException as e:
@@ -44,41 +96,92 @@ def get_previous_counts():
     """Reads the last known date counts from the state file."""
     print(f"LOG: Reading previous date counts from '{STATE_FILE_PATH}'...")
     try:
-        with open(STATE_FILE_PATH, 'r') as f:
-            data = json.load(f)
-            print(f"LOG: Successfully loaded previous counts for {len(data)} dates.")
-            return data
+        with open(STATE_FILE_PATH, 'rb') as f:
+            data = msgpack.unpackb(f.read())
+        if not isinstance(data, dict):
+            raise ValueError("state is not a map")
+        data = {sys.intern(date): count for date, count in data.items()}
+        print(f"LOG: Successfully loaded previous counts for {len(data)} dates.")
+        return data
     except FileNotFoundError:
         print("LOG: State file not found. Assuming this is the first run.")
         return {}
-    except json.JSONDecodeError:
+    except ValueError:
         print("ERROR: State file is corrupted or empty. Starting fresh.")
         return {}
 
+def write_state_file(path, data):
+    """Atomically writes data as msgpack to path. Returns False if the file already held it."""
+    # Keys are sorted so identical data always packs to identical bytes.
+    payload = msgpack.packb(dict(sorted(data.items())))
+
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == payload:
+                return False
+    except FileNotFoundError:
+        pass
+
+    # Write to a temporary file first so a crash never leaves a truncated state file.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return True
+
 def save_current_counts(counts):
     """Saves the current date counts to the state file."""
     print(f"LOG: Saving current counts for {len(counts)} dates to '{STATE_FILE_PATH}'...")
     # No longer need to create a directory, saving to root.
-    with open(STATE_FILE_PATH, 'w') as f:
-        json.dump(counts, f, indent=2, sort_keys=True)
-    print("LOG: Save complete.")
+    if write_state_file(STATE_FILE_PATH, counts):
+        print("LOG: Save complete.")
+    else:
+        print("LOG: State file already up to date. Skipped write.")
+
+def get_http_cache():
+    """Reads the ETag/Last-Modified validators and body hash saved from the previous fetch."""
+    try:
+        with open(HTTP_CACHE_PATH, 'rb') as f:
+            cache = msgpack.unpackb(f.read())
+        if not isinstance(cache, dict):
+            raise ValueError("HTTP cache is not a map")
+        return cache
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        print("ERROR: HTTP cache file is corrupted or empty. Ignoring it.")
+        return {}
+
+def save_http_cache(response, body_hash):
+    """Saves the validators and body hash of the given response for the next run."""
+    cache = {
+        'body_hash': body_hash,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+    write_state_file(HTTP_CACHE_PATH, cache)
 
 def format_changes(previous, current):
     """Creates a human-readable string detailing changes in date counts."""
-    all_dates = sorted(list(set(previous.keys()) | set(current.keys())), reverse=True)
+    # Only the dates whose count differs get sorted and formatted.
+    changed_dates = [
+        date for date in previous.keys() | current.keys()
+        if previous.get(date, 0) != current.get(date, 0)
+    ]
     
     changes = []
-    for date in all_dates:
+    for date in sorted(changed_dates, reverse=True):
         old_count = previous.get(date, 0)
         new_count = current.get(date, 0)
         
-        if old_count != new_count:
-            if old_count == 0:
-                changes.append(f"✅ <b>New:</b> {date} (Count: {new_count})")
-            elif new_count == 0:
-                changes.append(f"❌ <b>Removed:</b> {date} (Was: {old_count})")
-            else:
-                changes.append(f"🔄 <b>Changed:</b> {date} (Count: {old_count} → <b>{new_count}</b>)")
+        if old_count == 0:
+            changes.append(f"✅ <b>New:</b> {date} (Count: {new_count})")
+        elif new_count == 0:
+            changes.append(f"❌ <b>Removed:</b> {date} (Was: {old_count})")
+        else:
+            changes.append(f"🔄 <b>Changed:</b> {date} (Count: {old_count} → <b>{new_count}</b>)")
                 
     return "\n".join(changes)
 
@@ -88,24 +191,45 @@ def check_for_updates():
 
     previous_counts = get_previous_counts()
 
+    # Only revalidate when there is saved state to fall back on.
+    http_cache = get_http_cache() if previous_counts else {}
+    conditional_headers = {}
+    if http_cache.get('etag'):
+        conditional_headers['If-None-Match'] = http_cache['etag']
+    if http_cache.get('last_modified'):
+        conditional_headers['If-Modified-Since'] = http_cache['last_modified']
+
     print(f"LOG: Fetching content from {NOTICES_URL}...")
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = requests.get(NOTICES_URL, headers=headers, timeout=20)
+        response = SESSION.get(NOTICES_URL, headers=conditional_headers, timeout=20)
         response.raise_for_status()
         print("LOG: Website fetched successfully.")
     except requests.exceptions.RequestException as e:
         print(f"FATAL ERROR: Could not fetch the website. Stopping script. Reason: {e}")
         return
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    page_text = soup.body.get_text(separator=' ', strip=True)
-    
-    date_pattern = r'\b(\d{1,2}\s+(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+\d{4})\b'
-    found_dates = re.findall(date_pattern, page_text, re.IGNORECASE)
-    
-    current_counts = dict(Counter(found_dates))
-    print(f"LOG: Found {len(found_dates)} total notices across {len(current_counts)} unique dates.")
+    if response.status_code == 304:
+        print("LOG: Page not modified since the last check. Nothing to do.")
+        print(f"--- SCRIPT END: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+        return
+
+    body_hash = hashlib.blake2b(response.content, digest_size=16).hexdigest()
+    if body_hash == http_cache.get('body_hash'):
+        print("LOG: Page body is identical to the last check. Nothing to do.")
+        # Keep any rotated ETag/Last-Modified so the next run can still get a 304.
+        save_http_cache(response, body_hash)
+        print(f"--- SCRIPT END: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+        return
+
+    page_bytes = NON_TEXT_RE.sub(b' ', response.content)
+    body_start = BODY_RE.search(page_bytes)
+    if body_start:
+        page_bytes = page_bytes[body_start.start():]
+    page_bytes = MARKUP_RE.sub(b' ', page_bytes)
+    # Count on the raw byte keys and decode/intern each distinct date only once.
+    date_counts = Counter(b' '.join(match.groups()) for match in DATE_RE.finditer(page_bytes))
+    current_counts = {sys.intern(date.decode('ascii')): count for date, count in date_counts.items()}
+    print(f"LOG: Found {sum(current_counts.values())} total notices across {len(current_counts)} unique dates.")
 
     if not previous_counts and current_counts:
         print("LOG: First run. Initializing state and sending welcome message.")
@@ -131,6 +255,7 @@ def check_for_updates():
         print("LOG: No changes detected. The date counts are identical.")
 
     save_current_counts(current_counts)
+    save_http_cache(response, body_hash)
     
     print(f"--- SCRIPT END: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
 
@@ -138,4 +263,8 @@ if __name__ == "__main__":
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         print("FATAL ERROR: Environment variables TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID must be set.")
     else:
-        check_for_updates()
+        try:
+            check_for_updates()
+        finally:
+            # Let any queued notification finish before the process exits.
+            EXECUTOR.shutdown(wait=True)